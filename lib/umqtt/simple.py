@@ -1,6 +1,5 @@
 import socket
 import struct
-from binascii import hexlify
 
 
 class MQTTException(Exception):
@@ -23,6 +22,7 @@ class MQTTClient:
             port = 8883 if ssl else 1883
         self.client_id = client_id
         self.sock = None
+        self.timeout = None
         self.server = server
         self.port = port
         self.ssl = ssl
@@ -36,9 +36,13 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # Reused by publish() and _send_str() so the hot path doesn't allocate headers
+        self._pkt = bytearray(4)
+        self._len_buf = bytearray(2)
 
     def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
+        struct.pack_into("!H", self._len_buf, 0, len(s))
+        self.sock.write(self._len_buf)
         self.sock.write(s)
 
     def _recv_len(self):
@@ -63,6 +67,7 @@ class MQTTClient:
         self.lw_retain = retain
 
     def connect(self, clean_session=True, timeout=None):
+        self.timeout = timeout
         self.sock = socket.socket()
         self.sock.settimeout(timeout)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
@@ -122,8 +127,8 @@ class MQTTClient:
         self.sock.write(b"\xc0\0")
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+        pkt = self._pkt
+        pkt[0] = 0x30 | qos << 1 | retain
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
@@ -181,7 +186,8 @@ class MQTTClient:
     # messages processed internally.
     def wait_msg(self):
         res = self.sock.read(1)
-        self.sock.setblocking(True)
+        # Back to the connect() timeout (blocking if None) after check_msg() polled non-blocking
+        self.sock.settimeout(self.timeout)
         if res is None:
             return None
         if res == b"":
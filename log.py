@@ -0,0 +1,168 @@
+"""Leveled, rate-limited logging for MicroPython
+
+Hot paths check the module-level flags before building any arguments,
+so a disabled level costs one attribute lookup and a branch:
+
+    if log.info_on:
+        log.info("Published %s data", name)
+
+Formatting only happens once a message passes the level check and its
+rate limit. Each format string may be emitted at most _RATE_BURST times
+per _RATE_WINDOW_MS, further calls are counted and reported once the
+window is over, either by the next call or by flush() from the main loop.
+
+With console output off and no ring buffer every level is disabled,
+since there is nowhere for the lines to go.
+"""
+try:
+    from micropython import const
+    from time import ticks_ms, ticks_diff, ticks_add
+except ImportError:
+    # CPython host, e.g. the supervisor tests
+    import time
+
+    def const(x):
+        return x
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def ticks_add(a, b):
+        return a + b
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+OFF = const(50)
+
+try:
+    from config import LOG_LEVEL
+except ImportError:
+    LOG_LEVEL = INFO
+
+try:
+    from config import LOG_TO_CONSOLE
+except ImportError:
+    LOG_TO_CONSOLE = True
+
+try:
+    from config import LOG_RING_SIZE
+except ImportError:
+    LOG_RING_SIZE = 0
+
+_RATE_WINDOW_MS = const(60000)
+_RATE_BURST = const(5)
+
+_PREFIXES = {DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E"}
+
+# Per format string: [window start, emitted in window, suppressed in window, suppressed total, level]
+_limits = {}
+suppressed = 0  # Messages dropped by the rate limiter since boot
+
+_ring = [None] * LOG_RING_SIZE
+_ring_pos = 0
+_next_flush = ticks_ms()
+
+debug_on = info_on = warning_on = error_on = False
+
+
+def set_level(level):
+    """Change the active level and update the fast-check flags"""
+    global debug_on, info_on, warning_on, error_on
+    if not LOG_TO_CONSOLE and not LOG_RING_SIZE:
+        level = OFF
+    debug_on = level <= DEBUG
+    info_on = level <= INFO
+    warning_on = level <= WARNING
+    error_on = level <= ERROR
+
+set_level(LOG_LEVEL)
+
+
+def _emit(level, text):
+    global _ring_pos
+    if LOG_TO_CONSOLE:
+        print(_PREFIXES[level], text)
+    if LOG_RING_SIZE:
+        _ring[_ring_pos] = "%s %d %s" % (_PREFIXES[level], ticks_ms(), text)
+        _ring_pos = (_ring_pos + 1) % LOG_RING_SIZE
+
+
+def _end_window(state, level, msg, now):
+    if state[2]:
+        _emit(level, "(%d similar suppressed) %s" % (state[2], msg))
+    state[0] = now
+    state[1] = 0
+    state[2] = 0
+
+
+def _log(level, msg, args):
+    global suppressed
+    now = ticks_ms()
+    state = _limits.get(msg)
+    if state is None:
+        state = _limits[msg] = [now, 0, 0, 0, level]
+    elif ticks_diff(now, state[0]) >= _RATE_WINDOW_MS:
+        _end_window(state, level, msg, now)
+
+    if state[1] >= _RATE_BURST:
+        state[2] += 1
+        state[3] += 1
+        suppressed += 1
+        return
+    state[1] += 1
+    _emit(level, msg % args if args else msg)
+
+
+def debug(msg, *args):
+    if debug_on:
+        _log(DEBUG, msg, args)
+
+def info(msg, *args):
+    if info_on:
+        _log(INFO, msg, args)
+
+def warning(msg, *args):
+    if warning_on:
+        _log(WARNING, msg, args)
+
+def error(msg, *args):
+    if error_on:
+        _log(ERROR, msg, args)
+
+
+def flush():
+    """Report suppressed counts for windows that ended without another call, cheap to call every loop"""
+    global _next_flush
+    now = ticks_ms()
+    if ticks_diff(now, _next_flush) < 0:
+        return
+    _next_flush = ticks_add(now, _RATE_WINDOW_MS // 4)
+    for msg, state in _limits.items():
+        if state[2] and ticks_diff(now, state[0]) >= _RATE_WINDOW_MS:
+            _end_window(state, state[4], msg, now)
+
+
+def recent():
+    """Return the lines held in the ring buffer, oldest first"""
+    lines = []
+    for i in range(LOG_RING_SIZE):
+        line = _ring[(_ring_pos + i) % LOG_RING_SIZE]
+        if line is not None:
+            lines.append(line)
+    return lines
+
+def suppressed_counts():
+    """Return {format string: messages suppressed since boot} for rate-limited messages"""
+    return {msg: state[3] for msg, state in _limits.items() if state[3]}
+
+def dump():
+    """Recent lines followed by per-message suppressed totals, as served over HTTP and MQTT"""
+    lines = recent()
+    for msg, count in suppressed_counts().items():
+        lines.append("suppressed %d: %s" % (count, msg))
+    return "\n".join(lines)
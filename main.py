@@ -1,12 +1,23 @@
-import network
-
 import time
+import gc
+import machine
 from machine import Pin, Timer
 import bluetooth
 from micropython import const
-from umqtt.simple import MQTTClient
+import log
+import supervisor
 from config import WIFI_SSID, WIFI_PASSWORD, QINGPING_MAC, RUUVI_MAC, MQTT_BROKER, MQTT_USERNAME, MQTT_PASSWORD, MQTT_PORT
 
+try:
+    from config import MEMORY_BUDGET_MODE
+except ImportError:
+    MEMORY_BUDGET_MODE = False
+
+try:
+    from config import WATCHDOG_ENABLED
+except ImportError:
+    WATCHDOG_ENABLED = False
+
 # LED setup
 led = Pin("LED", Pin.OUT)
 led_state = False
@@ -21,6 +32,131 @@ _RUUVI_COMPANY_ID = const(0x0499)
 MQTT_CLIENT_ID = "pico_ble_scanner"
 MQTT_QINGPING_TOPIC = "homeassistant/sensor/qingping"
 MQTT_RUUVI_TOPIC = "homeassistant/sensor/ruuvi"
+MQTT_HEAP_TOPIC = "homeassistant/sensor/pico_ble_scanner/heap"
+MQTT_LOG_TOPIC = "homeassistant/sensor/pico_ble_scanner/log"
+MQTT_LOG_REQUEST_TOPIC = "homeassistant/sensor/pico_ble_scanner/log/get"
+MQTT_BOOT_TOPIC = "homeassistant/sensor/pico_ble_scanner/boot"
+MQTT_RESET_TOPIC = "homeassistant/sensor/pico_ble_scanner/reset"
+
+# Network bring-up, driven from the main loop so scanning never waits on it
+_WIFI_CONNECT_TIMEOUT_MS = const(10000)
+_MQTT_TIMEOUT_S = const(2)  # Socket timeout for every MQTT operation
+_NET_RETRY_MS = const(5000)
+
+# Watchdog supervision: the WDT is only fed while every stage progresses within its deadline
+_WDT_TIMEOUT_MS = const(8000)  # RP2040 maximum is 8388 ms
+_STAGE_SCAN = const(0)  # A BLE scan completed
+_STAGE_DECODE = const(1)  # A buffered advertisement was decoded, or none was waiting
+_STAGE_PUBLISH = const(2)  # A reading was published, none was waiting, or WiFi was down
+_STAGE_NETWORK = const(3)  # WiFi was up, or no reading was waiting
+_STAGE_NAMES = ("scan", "decode", "publish", "network")
+# Timing budget: each blocking MQTT step (TCP connect, CONNACK, SUBACK, one publish)
+# is bounded by _MQTT_TIMEOUT_S and watchdog_checkpoint() runs check() between steps,
+# so the longest gap between checks is connect() at 2 x 2 s, plus DNS if MQTT_BROKER
+# is a hostname. Decode is marked once per service() pass, so a pass whose network
+# steps add up to more than 6 s trips with a report, still at least 2 s before the
+# 8 s WDT. Publish covers WiFi-up-but-MQTT-down, network bounds a WiFi outage.
+_STAGE_DEADLINES_MS = [180000, 6000, 900000, 3600000]
+
+# Preallocated buffers, one slot per sensor
+_PENDING_NONE = const(0)
+_PENDING_READY = const(1)
+_PENDING_BUSY = const(2)  # Being decoded or published, the IRQ must not overwrite it
+_PENDING_DECODED = const(3)  # Payload built, waiting for MQTT
+_SLOT_QINGPING = const(0)
+_SLOT_RUUVI = const(1)
+_NUM_SLOTS = const(2)
+_ADV_BUF_SIZE = const(64)
+_PAYLOAD_BUF_SIZE = const(128)  # Heap reports
+_SLOT_PAYLOAD_SIZE = const(96)  # Longest Ruuvi payload is 65 bytes
+_SLOT_NAMES = ("Qingping", "Ruuvi")
+_SLOT_TOPICS = (MQTT_QINGPING_TOPIC, MQTT_RUUVI_TOPIC)
+
+# JSON fragments used to build payloads in place
+_JSON_TEMPERATURE = b'{"temperature": '
+_JSON_HUMIDITY = b', "humidity": '
+_JSON_PRESSURE = b', "pressure": '
+_JSON_HEAP_ALLOC = b'{"alloc": '
+_JSON_HEAP_ALLOC_MAX = b', "alloc_max": '
+_JSON_HEAP_PEAK = b', "peak": '
+_JSON_HEAP_FREE_MIN = b', "free_min": '
+_JSON_END = b'}'
+
+# Main loop and memory budget timing
+_SERVICE_PERIOD_MS = const(100)
+_GC_INTERVAL_MS = const(10000)
+_HEAP_REPORT_INTERVAL_MS = const(60000)
+
+
+# Boot phases as (name, ms since reset), used to track time-to-first-publish
+boot_phases = []
+
+def mark_boot_phase(name):
+    """Record the first time a startup phase is reached"""
+    for phase, _ in boot_phases:
+        if phase == name:
+            return
+    ms = time.ticks_ms()
+    boot_phases.append((name, ms))
+    if log.debug_on:
+        log.debug("Boot phase %s at %d ms", name, ms)
+
+mark_boot_phase("import")
+
+def mac_to_bytes(mac):
+    """Convert an 'aa:bb:cc:dd:ee:ff' MAC string to 6 raw bytes"""
+    return bytes([int(part, 16) for part in mac.split(':')])
+
+QINGPING_ADDR = mac_to_bytes(QINGPING_MAC)
+RUUVI_ADDR = mac_to_bytes(RUUVI_MAC)
+
+def addr_matches(addr, mac):
+    """Compare a raw BLE address with a MAC without allocating"""
+    for i in range(6):
+        if addr[i] != mac[i]:
+            return False
+    return True
+
+def div_round(value, divisor):
+    """Integer division rounding half away from zero"""
+    if value < 0:
+        return -((divisor // 2 - value) // divisor)
+    return (value + divisor // 2) // divisor
+
+def put_bytes(buf, pos, data):
+    """Copy data into buf at pos, return the new position"""
+    for b in data:
+        buf[pos] = b
+        pos += 1
+    return pos
+
+def put_fixed(buf, pos, value, decimals):
+    """Write the fixed-point number value / 10**decimals as ASCII into buf, return the new position"""
+    if value < 0:
+        buf[pos] = 0x2D  # '-'
+        pos += 1
+        value = -value
+    scale = 1
+    for _ in range(decimals):
+        scale *= 10
+    whole = value // scale
+    digit = 1
+    while digit * 10 <= whole:
+        digit *= 10
+    while digit:
+        buf[pos] = 0x30 + whole // digit % 10
+        pos += 1
+        digit //= 10
+    if decimals:
+        buf[pos] = 0x2E  # '.'
+        pos += 1
+        frac = value % scale
+        scale //= 10
+        while scale:
+            buf[pos] = 0x30 + frac // scale % 10
+            pos += 1
+            scale //= 10
+    return pos
 
 # Timer for LED blinking
 def blink_timer(timer):
@@ -38,267 +174,434 @@ global_scanner = None
 
 class BLEScanner:
     def __init__(self):
-        print("Initializing BLE Scanner...")
+        log.info("Initializing BLE Scanner...")
+        # Preallocate everything the scan/publish path touches so it runs without heap churn
+        self.adv_bufs = [bytearray(_ADV_BUF_SIZE) for _ in range(_NUM_SLOTS)]
+        self.adv_lens = bytearray(_NUM_SLOTS)
+        self.seen = bytearray(_NUM_SLOTS)  # Devices seen during current scan
+        self.pending = bytearray(_NUM_SLOTS)  # Buffered advertisements waiting to be decoded or published
+        self.slot_payloads = [bytearray(_SLOT_PAYLOAD_SIZE) for _ in range(_NUM_SLOTS)]
+        self.slot_payload_mvs = [memoryview(buf) for buf in self.slot_payloads]
+        self.payload_lens = bytearray(_NUM_SLOTS)
+        self.payload_buf = bytearray(_PAYLOAD_BUF_SIZE)
+        self.payload_mv = memoryview(self.payload_buf)
+        self.scan_done = False
+        self.log_requested = False
+        self.heap_peak = 0
+        self.heap_alloc_max = 0
+        self.heap_free_min = 0
+        self.last_gc = time.ticks_ms()
+        self.last_heap_report = self.last_gc
         self.ble = bluetooth.BLE()
         self.ble.active(True)
         self.ble.irq(self.ble_irq)
+        # WiFi and MQTT come up later from service(), BLE scanning doesn't wait for them
         self.mqtt_client = None
         self.mqtt_connected = False
         self.wlan = None
-        self.connect_mqtt()
-        self.devices_seen_this_scan = set()  # Track devices seen during current scan
-        print("BLE Scanner initialized and active")
+        self.wifi_up = False
+        self.wifi_connecting = False
+        self.wifi_deadline = 0
+        self.net_retry_at = time.ticks_ms()
+        self.boot_reported = False
+        self.supervisor = None
+        self.reset_report = supervisor.read_report()
+        if self.reset_report is None and machine.reset_cause() == machine.WDT_RESET:
+            self.reset_report = '{"reason": "watchdog reset without report"}'
+        if self.reset_report:
+            log.warning("Previous reset: %s", self.reset_report)
+        if MEMORY_BUDGET_MODE:
+            gc.collect()
+            self.heap_alloc_max = gc.mem_alloc()
+            self.heap_free_min = gc.mem_free()
+        log.info("BLE Scanner initialized and active")
 
     def connect_mqtt(self):
-        """Connect or reconnect to MQTT broker with retry logic"""
-        max_retries = 5
-        retry_count = 0
-        
-        while retry_count < max_retries:
+        """Make a single MQTT connection attempt, return True on success"""
+        if self.mqtt_client is None:
+            # Deferred so the MQTT library isn't loaded before the network is up
+            from umqtt.simple import MQTTClient
+            self.mqtt_client = MQTTClient(
+                MQTT_CLIENT_ID,
+                MQTT_BROKER,
+                port=MQTT_PORT,
+                user=MQTT_USERNAME,
+                password=MQTT_PASSWORD
+            )
+            self.mqtt_client.set_callback(self.on_mqtt_message)
+        try:
+            log.info("Attempting MQTT connection...")
+            # The client object is reused across reconnects, only its socket is replaced
+            self.close_mqtt_socket()
+            self.watchdog_checkpoint()
+            self.mqtt_client.connect(timeout=_MQTT_TIMEOUT_S)
+            if log.LOG_RING_SIZE:
+                self.watchdog_checkpoint()
+                self.mqtt_client.subscribe(MQTT_LOG_REQUEST_TOPIC)
+            self.mqtt_connected = True
+            log.info("Connected to MQTT broker")
+            return True
+        except Exception as e:
+            log.warning("MQTT connection failed: %s", e)
+            self.mqtt_connected = False
+            return False
+
+    def close_mqtt_socket(self):
+        """Close the socket left over from a previous MQTT session"""
+        if self.mqtt_client.sock:
             try:
-                print(f"Attempting MQTT connection (attempt {retry_count + 1}/{max_retries})...")
-                self.mqtt_client = MQTTClient(
-                    MQTT_CLIENT_ID,
-                    MQTT_BROKER,
-                    port=MQTT_PORT,
-                    user=MQTT_USERNAME,
-                    password=MQTT_PASSWORD
-                )
-                self.mqtt_client.connect()
-                self.mqtt_connected = True
-                print("Connected to MQTT broker")
-                return True
-            except Exception as e:
-                retry_count += 1
-                print(f"MQTT connection failed: {e}")
-                if retry_count < max_retries:
-                    print(f"Retrying in 5 seconds...")
-                    time.sleep(5)
-                else:
-                    print("Max MQTT connection retries reached")
-                    self.mqtt_connected = False
-                    return False
+                self.mqtt_client.sock.close()
+            except OSError:
+                pass
+            self.mqtt_client.sock = None
 
     def check_wifi_connection(self):
         """Check if WiFi is still connected"""
         if not self.wlan:
+            import network
             self.wlan = network.WLAN(network.STA_IF)
         return self.wlan.status() == 3
 
-    def connect_wifi(self):
-        """Connect or reconnect to WiFi"""
-        print("Connecting to WiFi...")
-        if not self.wlan:
-            self.wlan = network.WLAN(network.STA_IF)
-        
-        self.wlan.active(True)
-        
-        # If already connected, no need to reconnect
-        if self.wlan.status() == 3:
-            print("WiFi already connected")
-            return True
-            
-        self.wlan.connect(WIFI_SSID, WIFI_PASSWORD)
-
-        max_wait = 10
-        while max_wait > 0:
-            if self.wlan.status() < 0 or self.wlan.status() >= 3:
-                break
-            max_wait -= 1
-            print('Waiting for WiFi connection...')
-            time.sleep(1)
-
-        if self.wlan.status() != 3:
-            print('WiFi connection failed')
-            return False
-        else:
-            print('WiFi Connected')
-            status = self.wlan.ifconfig()
-            print('IP:', status[0])
-            return True
+    def service_network(self):
+        """Advance WiFi and MQTT bring-up by one step without blocking on association"""
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.net_retry_at) < 0:
+            return
 
-    def publish_mqtt(self, topic, payload):
-        """Publish to MQTT with automatic WiFi and MQTT reconnection"""
-        # First check WiFi connection and reconnect if needed
         if not self.check_wifi_connection():
-            print("WiFi disconnected, attempting reconnection...")
-            if not self.connect_wifi():
-                print("Failed to reconnect WiFi, skipping publish")
-                return False
-            # WiFi reconnected, need to reconnect MQTT too
-            self.mqtt_connected = False
-        
+            self.wifi_up = False
+            if not self.wifi_connecting:
+                log.info("Connecting to WiFi...")
+                self.wlan.active(True)
+                self.wlan.connect(WIFI_SSID, WIFI_PASSWORD)
+                self.wifi_connecting = True
+                self.wifi_deadline = time.ticks_add(now, _WIFI_CONNECT_TIMEOUT_MS)
+            elif self.wlan.status() < 0 or time.ticks_diff(now, self.wifi_deadline) >= 0:
+                log.warning('WiFi connection failed, retrying in %d ms', _NET_RETRY_MS)
+                self.wifi_connecting = False
+                self.net_retry_at = time.ticks_add(now, _NET_RETRY_MS)
+            return
+
+        if not self.wifi_up:
+            self.wifi_up = True
+            self.wifi_connecting = False
+            log.info('WiFi Connected, IP: %s', self.wlan.ifconfig()[0])
+            mark_boot_phase("wifi_up")
+
+        if not self.connect_mqtt():
+            self.net_retry_at = time.ticks_add(time.ticks_ms(), _NET_RETRY_MS)
+            return
+        mark_boot_phase("mqtt_up")
+
+    def publish_mqtt(self, topic, payload):
+        """Publish to MQTT, a failure marks the connection down for service_network() to restore"""
         if not self.mqtt_connected:
-            print("MQTT not connected, attempting reconnection...")
-            if not self.connect_mqtt():
-                print("Failed to reconnect to MQTT, skipping publish")
-                return False
-        
+            return False
+        self.watchdog_checkpoint()
         try:
             self.mqtt_client.publish(topic, payload)
             return True
         except Exception as e:
-            print(f"MQTT publish failed: {e}")
+            log.warning("MQTT publish failed: %s", e)
             self.mqtt_connected = False
-            # Try to reconnect and publish again
-            if self.connect_mqtt():
-                try:
-                    self.mqtt_client.publish(topic, payload)
-                    return True
-                except Exception as e2:
-                    print(f"MQTT publish failed after reconnection: {e2}")
-                    return False
             return False
 
     def ble_irq(self, event, data):
         if event == _IRQ_SCAN_RESULT:
             addr_type, addr, adv_type, rssi, adv_data = data
-            addr_str = ':'.join(['%02x' % i for i in addr])
+            if addr_matches(addr, QINGPING_ADDR):
+                slot = _SLOT_QINGPING
+            elif addr_matches(addr, RUUVI_ADDR):
+                slot = _SLOT_RUUVI
+            else:
+                return
 
-            # Skip if we've already seen this device in this scan
-            if addr_str in self.devices_seen_this_scan:
+            # Skip if we've already seen this device in this scan or its data is being published.
+            # Data still waiting for the network is replaced with the newer reading.
+            if self.seen[slot] or self.pending[slot] == _PENDING_BUSY:
                 return
 
-            if addr_str == QINGPING_MAC:
-                self.devices_seen_this_scan.add(addr_str)  # Mark as seen
-                qingping_data = self.parse_qingping_data(adv_data)
-                if qingping_data:
-                    import json
-                    payload = json.dumps(qingping_data)
-                    if self.publish_mqtt(MQTT_QINGPING_TOPIC, payload):
-                        print("Published Qingping data:", payload)
-                        timer.init(period=500, mode=Timer.PERIODIC, callback=blink_timer)
-                    else:
-                        print("Failed to publish Qingping data")
-
-            elif addr_str == RUUVI_MAC:
-                self.devices_seen_this_scan.add(addr_str)  # Mark as seen
-                ruuvi_data = self.parse_ruuvi_data(adv_data)
-                if ruuvi_data:
-                    import json
-                    payload = json.dumps(ruuvi_data)
-                    if self.publish_mqtt(MQTT_RUUVI_TOPIC, payload):
-                        print("Published Ruuvi data:", payload)
-                        timer.init(period=500, mode=Timer.PERIODIC, callback=blink_timer)
-                    else:
-                        print("Failed to publish Ruuvi data")
+            # Copy into the slot buffer, decoding and publishing happen in service()
+            self.seen[slot] = 1  # Mark as seen
+            buf = self.adv_bufs[slot]
+            n = min(len(adv_data), _ADV_BUF_SIZE)
+            for i in range(n):
+                buf[i] = adv_data[i]
+            self.adv_lens[slot] = n
+            self.pending[slot] = _PENDING_READY
 
         elif event == _IRQ_SCAN_DONE:
-            print("Scan complete")
-            self.devices_seen_this_scan.clear()  # Clear the set for next scan
+            for slot in range(_NUM_SLOTS):
+                self.seen[slot] = 0  # Clear for next scan
+            self.scan_done = True
+            if self.supervisor:
+                self.supervisor.progress(_STAGE_SCAN)
+
+    def service(self):
+        """Publish buffered sensor data and run housekeeping outside the BLE IRQ"""
+        # Decode new readings right away, they are published once MQTT is up
+        ready = False
+        for slot in range(_NUM_SLOTS):
+            if self.pending[slot] == _PENDING_READY:
+                ready = True
+                self.decode_slot(slot)
+        if self.supervisor and not ready:
+            self.supervisor.progress(_STAGE_DECODE)
+
+        if not self.mqtt_connected:
+            self.service_network()
+
+        waiting = False
+        for slot in range(_NUM_SLOTS):
+            if self.pending[slot] == _PENDING_DECODED and self.mqtt_connected:
+                self.publish_slot(slot)
+            if self.pending[slot] == _PENDING_DECODED:
+                waiting = True
+
+        if self.supervisor:
+            # WiFi up with MQTT down counts against publish, WiFi down against network
+            if not waiting or not self.wifi_up:
+                self.supervisor.progress(_STAGE_PUBLISH)
+            if not waiting or self.wifi_up:
+                self.supervisor.progress(_STAGE_NETWORK)
+
+        if self.reset_report and self.mqtt_connected:
+            if self.publish_mqtt(MQTT_RESET_TOPIC, self.reset_report):
+                supervisor.clear_report()
+                self.reset_report = None
+
+        if self.scan_done:
+            self.scan_done = False
+            if log.debug_on:
+                log.debug("Scan complete")
             timer.init(period=1000, mode=Timer.PERIODIC, callback=blink_timer)
 
-    def parse_qingping_data(self, adv_data):
+        if log.LOG_RING_SIZE and self.mqtt_connected:
+            self.poll_log_requests()
+
+        log.flush()
+
+        if MEMORY_BUDGET_MODE:
+            self.collect_garbage()
+
+    def on_mqtt_message(self, topic, msg):
+        # MQTT_LOG_REQUEST_TOPIC is the only subscription
+        self.log_requested = True
+
+    def poll_log_requests(self):
+        """Answer requests on MQTT_LOG_REQUEST_TOPIC with the recent log lines"""
+        try:
+            self.mqtt_client.check_msg()
+        except Exception as e:
+            log.warning("MQTT check failed: %s", e)
+            self.mqtt_connected = False
+            return
+        if self.log_requested:
+            self.log_requested = False
+            self.publish_mqtt(MQTT_LOG_TOPIC, log.dump())
+
+    def decode_slot(self, slot):
+        """Decode a buffered advertisement into the slot's payload buffer"""
+        self.pending[slot] = _PENDING_BUSY
+        adv = self.adv_bufs[slot]
+        n = self.adv_lens[slot]
+        buf = self.slot_payloads[slot]
+        if slot == _SLOT_QINGPING:
+            size = self.encode_qingping_payload(adv, n, buf)
+        else:
+            size = self.encode_ruuvi_payload(adv, n, buf)
+        self.payload_lens[slot] = size
+        self.pending[slot] = _PENDING_DECODED if size else _PENDING_NONE
+        if self.supervisor:
+            self.supervisor.progress(_STAGE_DECODE)
+
+    def publish_slot(self, slot):
+        """Publish a decoded reading, it stays pending if the publish fails"""
+        self.pending[slot] = _PENDING_BUSY
+        if self.publish_mqtt(_SLOT_TOPICS[slot], self.slot_payload_mvs[slot][:self.payload_lens[slot]]):
+            self.pending[slot] = _PENDING_NONE
+            if self.supervisor:
+                self.supervisor.progress(_STAGE_PUBLISH)
+            if log.info_on:
+                log.info("Published %s data", _SLOT_NAMES[slot])
+            timer.init(period=500, mode=Timer.PERIODIC, callback=blink_timer)
+            if not self.boot_reported:
+                self.report_boot()
+            return
+        self.pending[slot] = _PENDING_DECODED
+        if log.warning_on:
+            log.warning("Failed to publish %s data", _SLOT_NAMES[slot])
+
+    def report_boot(self):
+        """Publish boot phase timings once the first sensor reading has gone out"""
+        mark_boot_phase("first_publish")
+        self.boot_reported = True
+        # One line for all phases, per-phase lines would hit the log rate limit
+        log.info("Boot phases (ms): %s", " ".join(["%s=%d" % phase for phase in boot_phases]))
+        import json
+        self.publish_mqtt(MQTT_BOOT_TOPIC, json.dumps(dict(boot_phases)))
+
+    def encode_qingping_payload(self, adv_data, n, buf):
+        """Decode Qingping service data into buf, return the payload length"""
         i = 0
-        while i < len(adv_data):
+        while i < n:
             length = adv_data[i]
-            if i + 1 < len(adv_data):
+            if i + 3 < n:
                 type_id = adv_data[i + 1]
                 if type_id == 0x16:  # Service Data
-                    service_uuid = int.from_bytes(adv_data[i + 2:i + 4], 'little')
+                    service_uuid = adv_data[i + 2] | (adv_data[i + 3] << 8)
                     if service_uuid == _QINGPING_UUID:
-                        service_data = adv_data[i + 4:i + length + 1]
-                        if len(service_data) >= 14:
-                            temp_raw = int.from_bytes(service_data[10:12], 'little')
-                            temp = temp_raw / 10.0
-                            hum_raw = int.from_bytes(service_data[12:14], 'little')
-                            humidity = hum_raw / 10.0
-                            return {
-                                'temperature': temp,
-                                'humidity': humidity
-                            }
+                        # Service data starts at i + 4, temperature and humidity are at offsets 10 and 12
+                        end = min(i + length + 1, n)
+                        if end - (i + 4) >= 14:
+                            temp = adv_data[i + 14] | (adv_data[i + 15] << 8)  # 0.1 °C
+                            humidity = adv_data[i + 16] | (adv_data[i + 17] << 8)  # 0.1 %
+                            pos = put_bytes(buf, 0, _JSON_TEMPERATURE)
+                            pos = put_fixed(buf, pos, temp, 1)
+                            pos = put_bytes(buf, pos, _JSON_HUMIDITY)
+                            pos = put_fixed(buf, pos, humidity, 1)
+                            return put_bytes(buf, pos, _JSON_END)
             i += length + 1
-        return None
+        return 0
 
-    def parse_ruuvi_data(self, adv_data):
+    def encode_ruuvi_payload(self, adv_data, n, buf):
+        """Decode Ruuvi data format 5 into buf, return the payload length"""
         i = 0
-        while i < len(adv_data):
+        while i < n:
             length = adv_data[i]
-            if i + 1 < len(adv_data):
+            if i + 3 < n:
                 type_id = adv_data[i + 1]
                 if type_id == 0xFF:  # Manufacturer Data
-                    company_id = int.from_bytes(adv_data[i + 2:i + 4], 'little')
+                    company_id = adv_data[i + 2] | (adv_data[i + 3] << 8)
                     if company_id == _RUUVI_COMPANY_ID:
-                        mfg_data = adv_data[i + 2:i + length + 1]
-                        if len(mfg_data) > 2 and mfg_data[2] == 0x05:  # Data format 5
-                            temp_raw = int.from_bytes(mfg_data[3:5], 'big', True)
-                            temp = temp_raw * 0.005
-                            hum_raw = int.from_bytes(mfg_data[5:7], 'big')
-                            humidity = hum_raw * 0.0025
-                            pressure_raw = int.from_bytes(mfg_data[7:9], 'big')
-                            pressure = (pressure_raw + 50000) / 100
-                            return {
-                                'temperature': round(temp, 2),
-                                'humidity': round(humidity, 2),
-                                'pressure': round(pressure, 2)
-                            }
+                        # Manufacturer data starts at i + 2 with the company id, format byte follows
+                        end = min(i + length + 1, n)
+                        if end - (i + 2) >= 9 and adv_data[i + 4] == 0x05:  # Data format 5
+                            temp_raw = (adv_data[i + 5] << 8) | adv_data[i + 6]
+                            if temp_raw & 0x8000:
+                                temp_raw -= 0x10000
+                            hum_raw = (adv_data[i + 7] << 8) | adv_data[i + 8]
+                            pressure_raw = (adv_data[i + 9] << 8) | adv_data[i + 10]
+                            pos = put_bytes(buf, 0, _JSON_TEMPERATURE)
+                            pos = put_fixed(buf, pos, div_round(temp_raw * 5, 10), 2)  # 0.005 °C steps
+                            pos = put_bytes(buf, pos, _JSON_HUMIDITY)
+                            pos = put_fixed(buf, pos, div_round(hum_raw * 25, 100), 2)  # 0.0025 % steps
+                            pos = put_bytes(buf, pos, _JSON_PRESSURE)
+                            pos = put_fixed(buf, pos, pressure_raw + 50000, 2)  # Pa offset by 50000
+                            return put_bytes(buf, pos, _JSON_END)
             i += length + 1
-        return None
+        return 0
+
+    def collect_garbage(self):
+        """Run gc.collect() on a fixed schedule and track heap high-water marks"""
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.last_gc) < _GC_INTERVAL_MS:
+            return
+        self.last_gc = now
+        alloc = gc.mem_alloc()
+        if alloc > self.heap_peak:
+            self.heap_peak = alloc
+        gc.collect()
+        alloc = gc.mem_alloc()
+        if alloc > self.heap_alloc_max:
+            self.heap_alloc_max = alloc
+        free = gc.mem_free()
+        if free < self.heap_free_min:
+            self.heap_free_min = free
+
+        if time.ticks_diff(now, self.last_heap_report) >= _HEAP_REPORT_INTERVAL_MS:
+            self.last_heap_report = now
+            self.report_heap(alloc)
+
+    def report_heap(self, alloc):
+        """Publish heap usage so long soak runs can verify the heap stays flat"""
+        log.info("Heap alloc: %d alloc max: %d peak: %d free min: %d",
+                 alloc, self.heap_alloc_max, self.heap_peak, self.heap_free_min)
+        buf = self.payload_buf
+        pos = put_bytes(buf, 0, _JSON_HEAP_ALLOC)
+        pos = put_fixed(buf, pos, alloc, 0)
+        pos = put_bytes(buf, pos, _JSON_HEAP_ALLOC_MAX)
+        pos = put_fixed(buf, pos, self.heap_alloc_max, 0)
+        pos = put_bytes(buf, pos, _JSON_HEAP_PEAK)
+        pos = put_fixed(buf, pos, self.heap_peak, 0)
+        pos = put_bytes(buf, pos, _JSON_HEAP_FREE_MIN)
+        pos = put_fixed(buf, pos, self.heap_free_min, 0)
+        pos = put_bytes(buf, pos, _JSON_END)
+        self.publish_mqtt(MQTT_HEAP_TOPIC, self.payload_mv[:pos])
+
+    def watchdog_checkpoint(self):
+        """Feed the WDT between blocking network steps if all stages are on time, without marking progress"""
+        if self.supervisor:
+            self.supervisor.check()
+
+    def metrics(self):
+        """Snapshot of gateway state, saved with the reset report"""
+        return {
+            'uptime_ms': time.ticks_ms(),
+            'wifi_up': self.wifi_up,
+            'mqtt_connected': self.mqtt_connected,
+            'pending': list(self.pending),
+            'heap_alloc': gc.mem_alloc(),
+            'heap_free': gc.mem_free(),
+            'heap_peak': self.heap_peak,
+            'log_suppressed': log.suppressed,
+            'boot': dict(boot_phases),
+        }
 
     def start_scan(self):
-        print("Starting BLE scan...")
+        if log.debug_on:
+            log.debug("Starting BLE scan...")
         self.ble.gap_scan(10000, 30000, 30000)
+        mark_boot_phase("scan_started")
 
     def cleanup(self):
         """Clean up MQTT connection"""
         if self.mqtt_connected and self.mqtt_client:
             try:
                 self.mqtt_client.disconnect()
-                print("MQTT disconnected cleanly")
+                log.info("MQTT disconnected cleanly")
             except:
                 pass
             self.mqtt_connected = False
 
 def ble_scan_timer(timer):
-    print("Starting periodic BLE scan...")
     global global_scanner
     if global_scanner:
         global_scanner.start_scan()
 
 def main():
-    print("Starting main program...")
+    log.info("Starting main program...")
     try:
-        # Connect to WiFi first
-        print("Initial WiFi connection...")
-        wlan = network.WLAN(network.STA_IF)
-        wlan.active(True)
-        wlan.connect(WIFI_SSID, WIFI_PASSWORD)
-
-        max_wait = 10
-        while max_wait > 0:
-            if wlan.status() < 0 or wlan.status() >= 3:
-                break
-            max_wait -= 1
-            print('Waiting for connection...')
-            time.sleep(1)
-
-        if wlan.status() != 3:
-            raise RuntimeError('Initial network connection failed')
-        else:
-            print('Connected')
-            status = wlan.ifconfig()
-            print('IP:', status[0])
-
-        # Initialize BLE scanner (it will handle WiFi reconnections internally)
+        # Start scanning right away, WiFi and MQTT are brought up from the main loop
         global global_scanner
         global_scanner = BLEScanner()
-        global_scanner.wlan = wlan  # Pass the WiFi connection object
-        
-        print("Starting initial BLE scan...")
+        mark_boot_phase("ble_ready")
+
+        log.info("Starting initial BLE scan...")
         global_scanner.start_scan()
-        time.sleep(1)  # Give time for initial scan
 
         # Setup periodic BLE scanning
         ble_timer.init(period=60000, mode=Timer.PERIODIC, callback=ble_scan_timer)
 
-        # Keep program running
+        if WATCHDOG_ENABLED:
+            global_scanner.supervisor = supervisor.Supervisor(
+                machine.WDT(timeout=_WDT_TIMEOUT_MS),
+                _STAGE_DEADLINES_MS,
+                _STAGE_NAMES,
+                snapshot=global_scanner.metrics
+            )
+
+        # Keep program running, connecting and publishing buffered data outside the BLE IRQ
         while True:
-            time.sleep(1)
+            global_scanner.service()
+            if global_scanner.supervisor:
+                global_scanner.supervisor.check()
+            time.sleep_ms(_SERVICE_PERIOD_MS)
 
     except KeyboardInterrupt:
-        print("Program terminated by user")
+        log.info("Program terminated by user")
     except Exception as e:
-        print(f"Error in main: {e}")
+        log.error("Error in main: %s", e)
         raise e
     finally:
         if global_scanner:
@@ -307,5 +610,5 @@ def main():
         timer.deinit()  # Clean up LED timer
 
 if __name__ == '__main__':
-    print("Program starting...")
+    log.info("Program starting...")
     main()
\ No newline at end of file
@@ -2,8 +2,14 @@ import bluetooth
 from micropython import const
 import time
 import socket
-import json
 from config import RUUVI_MAC, QINGPING_MAC
+import log
+import supervisor
+
+try:
+    from config import WATCHDOG_ENABLED
+except ImportError:
+    WATCHDOG_ENABLED = False
 
 # BLE Constants
 _IRQ_SCAN_RESULT = const(5)
@@ -13,6 +19,17 @@ _RUUVI_COMPANY_ID = const(0x0499)
 
 # Web server settings
 HTTP_PORT = 8000
+_CLIENT_TIMEOUT_S = const(1)
+
+# Watchdog supervision
+_WDT_TIMEOUT_MS = const(8000)
+_STAGE_SCAN = const(0)  # A BLE scan completed
+_STAGE_SERVE = const(1)  # A web request poll finished, checked right after it
+_STAGE_NAMES = ("scan", "serve")
+# A request is one recv and up to two sends, each bounded by _CLIENT_TIMEOUT_S, so
+# about 3 s worst case. Anything slower trips serve with a report at 6 s, leaving
+# 2 s before the 8 s WDT fires
+_STAGE_DEADLINES_MS = [90000, 6000]
 
 class BLESensorServer:
     def __init__(self):
@@ -21,6 +38,19 @@ class BLESensorServer:
         self.ble.active(True)
         self.ble.irq(self.ble_irq)
         self.scanning = False
+        self.supervisor = None
+        if WATCHDOG_ENABLED:
+            from machine import WDT
+            self.supervisor = supervisor.Supervisor(
+                WDT(timeout=_WDT_TIMEOUT_MS),
+                _STAGE_DEADLINES_MS,
+                _STAGE_NAMES,
+                snapshot=self.metrics
+            )
+        # Served at GET /reset and cleared once delivered
+        self.reset_report = supervisor.read_report()
+        if self.reset_report:
+            log.warning("Previous reset: %s", self.reset_report)
         
         # Store latest sensor data
         self.sensor_data = {
@@ -37,13 +67,43 @@ class BLESensorServer:
         addr = socket.getaddrinfo('0.0.0.0', HTTP_PORT)[0][-1]
         self.sock.bind(addr)
         self.sock.listen(1)
-        print(f'Web server listening on port {HTTP_PORT}')
+        self.sock.setblocking(False)  # Polled from the scan loop, accept() must not block
+        log.info('Web server listening on port %d', HTTP_PORT)
+
+    def metrics(self):
+        """Snapshot of server state, saved with the reset report"""
+        return {
+            'uptime_ms': time.ticks_ms(),
+            'sensor_data': self.sensor_data,
+            'log_suppressed': log.suppressed,
+        }
 
     def handle_web_request(self):
         try:
             cl, addr = self.sock.accept()
+        except OSError:
+            return  # No client waiting
+        try:
+            cl.settimeout(_CLIENT_TIMEOUT_S)
             request = cl.recv(1024).decode()
             
+            if 'GET /log' in request:  # Recent log lines and suppressed counts
+                cl.send('HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n')
+                cl.send(log.dump())
+                cl.close()
+                return
+
+            if 'GET /reset' in request:  # Report left by the last watchdog reset
+                if self.reset_report:
+                    cl.send('HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n\r\n')
+                    cl.send(self.reset_report)
+                    supervisor.clear_report()
+                    self.reset_report = None
+                else:
+                    cl.send('HTTP/1.0 404 Not Found\r\n\r\n')
+                cl.close()
+                return
+
             response_data = None
             if 'GET /1' in request:  # Qingping endpoint
                 response_data = self.sensor_data['qingping']
@@ -51,6 +111,7 @@ class BLESensorServer:
                 response_data = self.sensor_data['ruuvi']
             
             if response_data:
+                import json
                 response = json.dumps(response_data)
                 cl.send('HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n\r\n')
                 cl.send(response)
@@ -59,19 +120,25 @@ class BLESensorServer:
             
             cl.close()
         except Exception as e:
-            print(f"Web server error: {e}")
+            log.warning("Web server error: %s", e)
             try:
                 cl.close()
             except:
                 pass
 
     def scan(self, duration_ms=5000):
-        print("Starting BLE scan...")
+        log.info("Starting BLE scan...")
         self.scanning = True
         self.ble.gap_scan(duration_ms, 30000, 30000)
         
         while self.scanning:
+            # Mark before the request so the check after it measures how long it took
+            if self.supervisor:
+                self.supervisor.progress(_STAGE_SERVE)
             self.handle_web_request()  # Handle web requests during scanning
+            log.flush()
+            if self.supervisor:
+                self.supervisor.check()
             time.sleep_ms(100)
 
     def parse_qingping(self, service_data):
@@ -88,7 +155,8 @@ class BLESensorServer:
                     'humidity': humidity
                 }
         except Exception as e:
-            print(f"Error parsing Qingping data: {e}")
+            if log.warning_on:
+                log.warning("Error parsing Qingping data: %s", e)
         return None
 
     def parse_ruuvi(self, mfg_data):
@@ -109,7 +177,8 @@ class BLESensorServer:
                     'pressure': round(pressure, 2)
                 }
         except Exception as e:
-            print(f"Error parsing Ruuvi data: {e}")
+            if log.warning_on:
+                log.warning("Error parsing Ruuvi data: %s", e)
         return None
 
     def ble_irq(self, event, data):
@@ -129,7 +198,8 @@ class BLESensorServer:
                             parsed = self.parse_qingping(adv_data[i + 4:i + length + 1])
                             if parsed:
                                 self.sensor_data['qingping'] = parsed
-                                print(f"Updated Qingping data: {parsed}")
+                                if log.info_on:
+                                    log.info("Updated Qingping data: %s", parsed)
                     i += length + 1
                     
             elif addr_str == RUUVI_MAC:
@@ -143,13 +213,17 @@ class BLESensorServer:
                             parsed = self.parse_ruuvi(adv_data[i + 2:i + length + 1])
                             if parsed:
                                 self.sensor_data['ruuvi'] = parsed
-                                print(f"Updated Ruuvi data: {parsed}")
+                                if log.info_on:
+                                    log.info("Updated Ruuvi data: %s", parsed)
                     i += length + 1
 
         elif event == _IRQ_SCAN_DONE:
-            print("Scan complete, restarting...")
+            if log.debug_on:
+                log.debug("Scan complete, restarting...")
             # Restart scanning immediately
             self.ble.gap_scan(30000, 30000, 30000)
+            if self.supervisor:
+                self.supervisor.progress(_STAGE_SCAN)
 
 # Create server and start continuous operation
 server = BLESensorServer()
@@ -157,5 +231,5 @@ while True:
     try:
         server.scan(30000)  # Scan for 30 seconds
     except Exception as e:
-        print(f"Error in main loop: {e}")
+        log.error("Error in main loop: %s", e)
         time.sleep(1)
@@ -0,0 +1,98 @@
+"""Watchdog supervisor with per-stage hang detection
+
+The main loop owns a hardware watchdog but only feeds it while every
+stage it supervises keeps making progress:
+
+    sup = Supervisor(WDT(timeout=8000), [180000, 7000], ("scan", "loop"))
+    sup.progress(0)   # from the BLE IRQ, does not allocate
+    sup.check()       # from the main loop, feeds the WDT when all stages are on time
+
+On the first missed deadline the reason and a metrics snapshot are
+written to REPORT_PATH and feeding stops, so the hardware watchdog
+resets the board. After reboot read_report() returns the record. If an
+earlier report was never delivered it is kept, and the reasons of later
+resets are appended to its 'later' list (at most _MAX_LATER).
+
+The WDT and clock are passed in, so the host simulator can drive the
+supervisor with a fake watchdog and a fake millisecond clock.
+"""
+import os
+import log
+from log import ticks_ms, ticks_diff
+
+REPORT_PATH = "reset_report.json"
+_MAX_LATER = 5
+
+
+class Supervisor:
+    def __init__(self, wdt, deadlines, names, snapshot=None, clock=None, path=REPORT_PATH):
+        self.wdt = wdt
+        self.deadlines = deadlines  # Per stage, max ms allowed between progress() calls
+        self.names = names
+        self.snapshot = snapshot  # Optional callable returning a dict of metrics
+        self.clock = clock or ticks_ms
+        self.path = path
+        self.last = [self.clock()] * len(deadlines)
+        self.tripped = False
+
+    def progress(self, stage):
+        """Record that stage made progress"""
+        self.last[stage] = self.clock()
+
+    def check(self):
+        """Feed the watchdog if every stage is within its deadline, return False once tripped"""
+        if self.tripped:
+            return False
+        now = self.clock()
+        for stage in range(len(self.deadlines)):
+            age = ticks_diff(now, self.last[stage])
+            if age > self.deadlines[stage]:
+                self.trip("%s stalled for %d ms" % (self.names[stage], age))
+                return False
+        self.wdt.feed()
+        return True
+
+    def trip(self, reason):
+        """Write the reset report and stop feeding the watchdog"""
+        self.tripped = True
+        log.error("Watchdog reset pending: %s", reason)
+        now = self.clock()
+        report = {
+            'reason': reason,
+            'stage_ages': {self.names[i]: ticks_diff(now, self.last[i]) for i in range(len(self.names))},
+        }
+        try:
+            if self.snapshot:
+                report['metrics'] = self.snapshot()
+            import json
+            earlier = read_report(self.path)
+            if earlier:
+                # Keep the oldest undelivered report, later resets only add their reason
+                try:
+                    earlier = json.loads(earlier)
+                    later = earlier.get('later', [])
+                    later.append(reason)
+                    earlier['later'] = later[-_MAX_LATER:]
+                    report = earlier
+                except ValueError:
+                    pass
+            with open(self.path, 'w') as f:
+                f.write(json.dumps(report))
+        except Exception as e:
+            log.error("Failed to write reset report: %s", e)
+
+
+def read_report(path=REPORT_PATH):
+    """Return the report left before the last watchdog reset, or None"""
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+def clear_report(path=REPORT_PATH):
+    """Remove the report once it has been delivered"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,87 @@
+"""Host tests for supervisor.Supervisor with a fake WDT and a fake clock"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import supervisor
+
+
+class FakeWDT:
+    def __init__(self):
+        self.feeds = 0
+
+    def feed(self):
+        self.feeds += 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.ms = 0
+
+    def __call__(self):
+        return self.ms
+
+
+def make_supervisor(tmp_path, snapshot=None):
+    wdt = FakeWDT()
+    clock = FakeClock()
+    path = str(tmp_path / 'reset_report.json')
+    sup = supervisor.Supervisor(wdt, [1000, 100], ("scan", "decode"),
+                                snapshot=snapshot, clock=clock, path=path)
+    return sup, wdt, clock, path
+
+
+def test_feeds_while_stages_are_on_time(tmp_path):
+    sup, wdt, clock, path = make_supervisor(tmp_path)
+    for _ in range(20):
+        clock.ms += 50
+        sup.progress(1)
+        if clock.ms % 500 == 0:
+            sup.progress(0)
+        assert sup.check()
+    assert wdt.feeds == 20
+    assert supervisor.read_report(path) is None
+
+
+def test_missed_deadline_stops_feeding_and_writes_report(tmp_path):
+    sup, wdt, clock, path = make_supervisor(tmp_path, snapshot=lambda: {'heap_alloc': 1234})
+    clock.ms = 50
+    sup.progress(1)
+    assert sup.check()
+
+    clock.ms = 200
+    assert not sup.check()
+    assert not sup.check()
+    assert wdt.feeds == 1
+
+    report = json.loads(supervisor.read_report(path))
+    assert report['reason'] == "decode stalled for 150 ms"
+    assert report['stage_ages'] == {'scan': 200, 'decode': 150}
+    assert report['metrics'] == {'heap_alloc': 1234}
+
+
+def test_report_is_cleared_after_delivery(tmp_path):
+    sup, wdt, clock, path = make_supervisor(tmp_path)
+    clock.ms = 2000
+    assert not sup.check()
+    assert supervisor.read_report(path) is not None
+
+    supervisor.clear_report(path)
+    assert supervisor.read_report(path) is None
+    supervisor.clear_report(path)  # Clearing twice is harmless
+
+
+def test_undelivered_report_is_kept_and_later_reasons_appended(tmp_path):
+    sup, wdt, clock, path = make_supervisor(tmp_path)
+    clock.ms = 200
+    sup.check()
+    for i in range(7):
+        later, wdt, clock, path = make_supervisor(tmp_path)
+        clock.ms = 500 + i
+        later.check()
+
+    report = json.loads(supervisor.read_report(path))
+    assert report['reason'] == "decode stalled for 200 ms"
+    assert report['later'] == ["decode stalled for %d ms" % (500 + i) for i in range(2, 7)]